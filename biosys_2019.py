@@ -11,13 +11,35 @@ import sys
 import os
 import glob
 import argparse
+import multiprocessing as mp
 import pandas as pd
-import send2trash
+import numpy as np
+from scipy import sparse
 import re
-from math import sqrt
-import statistics as stat
+from functools import lru_cache, partial
+from collections import Counter
 from metadata import *
 
+try:
+    import numba #optional, compiles the similarity kernel
+except ImportError:
+    numba = None
+
+try:
+    import xlsxwriter
+    EXCEL_ENGINE = "xlsxwriter" #much faster than openpyxl for large sheets
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+try:
+    import pyarrow.csv as pa_csv #multithreaded parser for the wide otu tables
+except ImportError:
+    pa_csv = None
+
+missing_run_metadata = "Run metadata has not been set"
+
+sitename_regex = re.compile('[^a-zA-Z ]') #strips everything but letters and spaces from site names
+
 #Class Objects:
 
 class Biosys_Version:
@@ -25,7 +47,6 @@ class Biosys_Version:
     version = ("\033[1;34m" + "\nBiosys Version: 2019.10" + "\033[0m")
     known_issues = '''\033[93mThis program is still in WIP stage \033[0m
 current issues:
-    -Multicore processing not supported.
     -Baroni-Urbani-Buser similarity not at 100% functional due to:
         -Takes too long to perform for entire dataset. -solved by optional?
         -Cut off for distance not determined.
@@ -43,6 +64,10 @@ class MathsError(Exception):
 
 class Diatom_Sample:
     """A slice of an OTU table, and associated metadata for a diatom sample."""
+    __slots__ = ("folder", "sampleid", "siteid", "area", "region", "reg_area", "prn",
+                 "sitename", "sampledate", "barcode", "batch_num", "count", "pass_fail",
+                 "analysis_date", "taxa", "counts", "otu_header", "sim", "sim_sample",
+                 "note", "plate_loc", "plate", "sur_samples", "_pres")
     #this imports data from the table from Tim
     def __init__(self, sampleid, siteid, area, region, prn, sitename, sampledate, barcode, folder):
         if folder:
@@ -94,8 +119,7 @@ class Diatom_Sample:
 
         if sitename:
             try:
-                regex = re.compile('[^a-zA-Z ]')
-                self.sitename = regex.sub('', sitename)
+                self.sitename = sitename_regex.sub('', sitename)
             except AttributeError:
                 self.sitename = no_value
             except TypeError:
@@ -118,46 +142,47 @@ class Diatom_Sample:
         self.count = 0
         self.pass_fail = "Unsuccessful"
         self.analysis_date = no_value
-        self.otu_tab = None
+        self.taxa = None
+        self.counts = None
+        self.otu_header = None
         self.sim = 0
         self.sim_sample = no_value
         self.note = ""
         self.plate_loc = no_value
-
-    def assign_results(self, otus, batch_num):
-        '''Assigns otu table results to the sample.'''
-        self.otu_tab = otus
-        try:
-            count = self.otu_tab[str(self.folder)].sum()
-            self.count = count
-        except KeyError:
+        self._pres = None
+
+    @property
+    def otu_tab(self):
+        '''The otu table of the sample as a PrefTaxon and counts DataFrame.'''
+        if self.counts is None:
+            return None
+        return pd.DataFrame({"PrefTaxon":self.taxa, self.otu_header:self.counts.toarray().ravel()})
+
+    def assign_results(self, taxa, counts, header, batch_num):
+        '''Assigns otu table results to the sample, taxa is shared with the other samples in the run
+        and counts is a one column sparse matrix from sparse_counts.'''
+        self.taxa = taxa
+        self.counts = counts
+        self.otu_header = header
+        if header == str(self.folder):
+            self.count = int(counts.sum())
+        else:
             self.count = 0
             print("Seq count for " + str(self.folder) + " has been set to 0.")
         if self.count >= 3000:
             self.pass_fail = "Successful"
         if batch_num:
             self.batch_num = str(batch_num).split(".")[0]
-            try:
-                date = batch_num_dict[self.batch_num]
-            except KeyError:
-                date = "Run metadata has not been set"
-                print(date + " for sample: " + str(self.folder) + " " + str(self.batch_num))
-            self.analysis_date = date
         else:
             self.batch_num = no_value
-            self.analysis_date = no_value
+        self.set_analysis_date()
 
     def set_analysis_date(self):
-        '''Sets the date of analysis to the date of the MiSeq run.'''
+        '''Sets the date of analysis to the date of the MiSeq run, missing runs are reported by import_otu_tables_main.'''
         if self.batch_num == no_value:
             self.analysis_date = no_value
         else:
-            try:
-                date = batch_num_dict[self.batch_num]
-            except KeyError:
-                date = "Run metadata has not been set"
-                print(date + " for sample: " + str(self.folder) + " " + str(self.batch_num))
-            self.analysis_date = date
+            self.analysis_date = batch_num_dict.get(self.batch_num, missing_run_metadata)
 
     def sort_control(self):
         if self.region == "Control":
@@ -205,7 +230,7 @@ class Diatom_Sample:
 #Global functions:
 
 def community_analysis_export(samples_otus, keep_list, control_regions):
-    otus_all_writer = pd.ExcelWriter("otus_all.xlsx")
+    otus_all_writer = pd.ExcelWriter("otus_all.xlsx", engine=EXCEL_ENGINE)
     print("Exporting all otus for community analysis")
     if keep_list[0] == "all":
         keep_list = ["Anglian", "Midlands", "South West", 
@@ -216,23 +241,14 @@ def community_analysis_export(samples_otus, keep_list, control_regions):
                      "Eurocentrl", "Dingwall", "Dumfries",
                      "Galashiels", "Bowlblank" ]
 
+    samples = []
     for sample in samples_otus:
         if sample.count >= 1:
             if sample.region in keep_list:
                 if sample.region in control_regions:
-                    try:
-                        sample.otu_tab.columns = ["PrefTaxon", sample.sampleid]   
-                        interim_df = sample.otu_tab
-                        main_df = pd.merge(main_df, interim_df, on="PrefTaxon")
-                    except NameError:
-                        main_df = sample.otu_tab
-                else:
-                    try:
-                        interim_df = sample.otu_tab
-                        main_df = pd.merge(main_df, interim_df, on="PrefTaxon")
-                    except NameError:
-                        main_df = sample.otu_tab
-    df = format_df(main_df)
+                    sample.otu_header = sample.sampleid
+                samples.append(sample)
+    df = format_df(merge_otu_tables(samples))
     df = df.transpose()
     df.to_excel(otus_all_writer, sheet_name="comunity_analysis", header=True, index=True)
     otus_all_writer.save()
@@ -244,6 +260,32 @@ def add_biosys_headers(df, biosys_dict):
     df = pd.concat([biosys_df, df], sort=True)
     return df
     
+def merge_otu_tables(samples):
+    '''Inner joins the otu tables of samples on PrefTaxon in a single pass.'''
+    headers = merge_headers([sample.otu_header for sample in samples])
+    taxa = samples[0].taxa
+    if all(sample.taxa is taxa for sample in samples):
+        #all tables share one taxa index so the counts can be stacked as they are
+        counts = sparse.hstack([sample.counts for sample in samples], format="csc").toarray()
+        df = pd.DataFrame(counts, index=taxa, columns=headers)
+    else:
+        frames = [sample.otu_tab.set_index("PrefTaxon") for sample in samples]
+        df = pd.concat(frames, axis=1, join="inner")
+        df.columns = headers
+    return df.reset_index()
+
+def merge_headers(headers):
+    '''Suffixes repeated headers with _x and _y as chained pd.merge calls did, repeat samples share a folder.'''
+    merged = []
+    positions = {}
+    for header in headers:
+        if header in positions:
+            merged[positions.pop(header)] = str(header) + "_x"
+            header = str(header) + "_y"
+        positions[header] = len(merged)
+        merged.append(header)
+    return merged
+
 def format_df(df):
     df = df[~df.PrefTaxon.str.contains("batch_num")]
     df = df.set_index(list(df)[0])
@@ -262,6 +304,7 @@ def filter_otus_by_region(region, samples_otus, writer, control_regions):
         no_reg.close()
     elif region == "TR":
         biosys_siteid_dict = {}
+        samples = []
         for sample_tr in samples_otus:
             if sample_tr.region == "TR":
                 if sample_tr.count >= 3000:
@@ -271,124 +314,193 @@ def filter_otus_by_region(region, samples_otus, writer, control_regions):
                         sample_original_fn = sample_tr.folder[2:9]
                     else:
                         sample_orignal_fn = sample_tr.folder
-                    try:
-                        interim_df = sample_tr.otu_tab
-                        main_df = pd.merge(main_df, interim_df, on="PrefTaxon")
-                    except NameError:
-                        main_df = sample_tr.otu_tab
+                    samples.append(sample_tr)
                     for sample_og in samples_otus:
                         if sample_og.folder == sample_original_fn:
                             if sample_og.region != region:
                                 if sample_og.count > 1:
-                                    interim_df = sample_og.otu_tab
-                                    main_df = pd.merge(main_df, interim_df, on="PrefTaxon")
-        try:
-            df = format_df(main_df)
+                                    samples.append(sample_og)
+        if samples:
+            df = format_df(merge_otu_tables(samples))
             df = add_biosys_headers(df, biosys_siteid_dict)
             df.to_excel(writer, sheet_name=region, header=True, index=True)
-        except UnboundLocalError:
+        else:
             print("    Region " + region + " had no passing samples.")
     elif region in control_regions:
+        samples = []
         for sample in samples_otus:
             if sample.region == region:
                 if sample.count >= 3000:
-                    try:
-                        interim_df = sample.otu_tab
-                        main_df = pd.merge(main_df, interim_df, on="PrefTaxon")
-                    except NameError:
-                        main_df = sample.otu_tab
-        try:
-            df = format_df(main_df)            
+                    samples.append(sample)
+        if samples:
+            df = format_df(merge_otu_tables(samples))
             df.to_excel(writer, sheet_name=region, header=True, index=True)
-        except UnboundLocalError:
+        else:
             print("    Region " + region + " had no passing samples.")
     else:
         biosys_siteid_dict = {}
+        samples = []
         for sample in samples_otus:
             if sample.region == region:
                 if sample.count >= 3000:
                     biosys_siteid_dict[sample.folder] = [str(sample.siteid), str(sample.sampleid)]
-                    try:
-                        interim_df = sample.otu_tab
-                        main_df = pd.merge(main_df, interim_df, on="PrefTaxon")
-                    except NameError:
-                        main_df = sample.otu_tab
-        try:
-            df = format_df(main_df)            
+                    samples.append(sample)
+        if samples:
+            df = format_df(merge_otu_tables(samples))
             df = add_biosys_headers(df, biosys_siteid_dict)
             df.to_excel(writer, sheet_name=region, header=True, index=True)
-        except UnboundLocalError:
+        else:
             print("    Region " + region + " had no passing samples.")
 
-def get_region_list(sample_list):
-    regions_all = []
+def get_folder_map(sample_list):
+    '''Maps each folder to its samples, repeat samples share a folder.'''
+    by_folder = {}
     for sample in sample_list:
-        regions_all.append(sample.region)
-    region_unique = []
-    for region in regions_all:
-        if region not in region_unique:
-            region_unique.append(region)
+        by_folder.setdefault(str(sample.folder), []).append(sample)
+    return by_folder
+
+def get_region_list(sample_list):
+    #dict keys keep the first seen order of the regions
+    region_unique = dict.fromkeys(sample.region for sample in sample_list)
     region_unique = [x for x in region_unique if str(x) != 'nan']
     return region_unique
 
-def delete_file(file_in):
-    file_exists = os.path.isfile(file_in)
-    if file_exists == True:
-        send2trash.send2trash(file_in)
-
 def save_sample_info(sample_list, writer, control_regions):
-    interim = "inter.text"
-    delete_file(interim)
-    file_interim = open(interim, "w")
-    header = ("SampleID,SiteID,Region,Area,PRN,Site Name,Sample Date,Barcode,Date of analysis,"
-              "BatchNum,Sequence Counts,Pass/Fail,FolderNumber,Notes\n")
-    file_interim.write(header)
+    rows = []
     for sample in sample_list:
         if sample.region in control_regions:
             pass
         else:
-            line = ( str(sample.sampleid) + "," + str(sample.siteid) + "," + str(sample.region) + "," +
-                    str(sample.area) + "," + str(sample.prn) + "," + str(sample.sitename) + "," +
-                    str(sample.sampledate) + "," + str(sample.barcode) + "," + 
-                    str(sample.analysis_date) + "," + str(sample.batch_num) + "," +
-                    str(sample.count) + "," + str(sample.pass_fail) + "," +
-                    str(sample.folder) + "," + str(sample.note) + "\n" )
-            file_interim.write(line)
-    file_interim.close()
-    sample_info_df = pd.read_csv(interim, delimiter = ",")
+            rows.append({"SampleID":str(sample.sampleid), "SiteID":str(sample.siteid),
+                         "Region":str(sample.region), "Area":str(sample.area),
+                         "PRN":str(sample.prn), "Site Name":str(sample.sitename),
+                         "Sample Date":str(sample.sampledate), "Barcode":str(sample.barcode),
+                         "Date of analysis":str(sample.analysis_date), "BatchNum":str(sample.batch_num),
+                         "Sequence Counts":str(sample.count), "Pass/Fail":str(sample.pass_fail),
+                         "FolderNumber":str(sample.folder), "Notes":str(sample.note)})
+    sample_info_df = pd.DataFrame(rows, columns=["SampleID", "SiteID", "Region", "Area", "PRN", "Site Name",
+                                                 "Sample Date", "Barcode", "Date of analysis", "BatchNum",
+                                                 "Sequence Counts", "Pass/Fail", "FolderNumber", "Notes"])
+    #keep numeric columns as numbers in the spreadsheet
+    for column in sample_info_df.columns:
+        try:
+            sample_info_df[column] = pd.to_numeric(sample_info_df[column])
+        except (ValueError, TypeError):
+            pass
     sample_info_df.to_excel(writer, sheet_name="Sample batch information", header=True, index=False)
 
 def baroni_urbani_buser_coefficient(df):
-    a = 0 #Num species present in both samples
-    b = 0 #Num species present in only sample 0
-    c = 0 #Num species present in only sample 1
-    d = 0 #Num species absent in both samples
     df = df.drop(columns="PrefTaxon")
-    for row_num in range(0, df.shape[0]):
-        #col 0 is sample 1, col 1 is sample 2
-        #Create binary data
-        count_0 = df.iloc[row_num][0]
-        if count_0 > 1:
-            count_0 = 1
-        count_1 = df.iloc[row_num][1]
-        if count_1 > 1:
-            count_1 = 1
-        #compare binary data
-        if count_0 == count_1:
-            if count_0 == 1:
-                a=a+1
-            else:
-                d=d+1
-        elif count_0 > count_1:
-            b=b+1
-        elif count_0 < count_1:
-            c=c+1
-        else:
-            MathsError
+    counts = df.to_numpy()
+    #col 0 is sample 1, col 1 is sample 2
+    #Create binary data
+    pres_0 = pack_presence(counts[:, 0] > 0)
+    pres_1 = pack_presence(counts[:, 1] > 0)
+    listed = pack_presence(np.ones(df.shape[0], dtype=bool))
+    return float(baroni_urbani_buser_packed(pres_0, pres_1, listed, listed))
+
+def pack_presence(pres):
+    '''Packs a boolean presence vector into uint64 words, 64 taxa per word.'''
+    padded = np.zeros(-(-len(pres) // 64) * 64, dtype=bool)
+    padded[:len(pres)] = pres
+    return np.packbits(padded).view(np.uint64)
+
+if hasattr(np, "bitwise_count"):
+    def popcount(words):
+        '''Counts the set bits along the last axis of an array of words.'''
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    def popcount(words):
+        '''Counts the set bits along the last axis of an array of words, via a byte lookup table for NumPy < 2.0.'''
+        return popcount_table[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+def baroni_urbani_buser_packed(pres_0, pres_1, listed_0, listed_1):
+    '''Calculates the coefficient from presence vectors packed by pack_presence, row by row if stacked.
+
+    listed_0 and listed_1 mark the taxa in each sample's otu table, only taxa listed in both are compared.'''
+    shared = listed_0 & listed_1
+    a = popcount(pres_0 & pres_1) #Num species present in both samples
+    b = popcount(pres_0 & ~pres_1 & shared) #Num species present in only sample 0
+    c = popcount(~pres_0 & pres_1 & shared) #Num species present in only sample 1
+    d = popcount(shared) - a - b - c #Num species absent in both samples
     #calculate coefficient
-    bub = float((sqrt(a*d) + a) / (sqrt(a*d) + a + b + c))
+    sqrt_ad = np.sqrt(a*d)
+    bub = (sqrt_ad + a) / (sqrt_ad + a + b + c)
     return bub
 
+if numba is not None:
+    @numba.njit(cache=True)
+    def popcount_word(x):
+        '''Counts the set bits of a uint64 with SWAR arithmetic, which LLVM lowers to POPCNT.'''
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+    @numba.njit(parallel=True, cache=True)
+    def neighbour_similarities_jit(packed, listed, listed_rows, neigh_off, neigh_idx):
+        '''Compiled neighbour_similarities, counting a, b, c and the shared taxa in one pass over each pair.'''
+        sims = np.zeros(len(neigh_idx))
+        for i in numba.prange(len(neigh_off) - 1):
+            for k in range(neigh_off[i], neigh_off[i + 1]):
+                j = neigh_idx[k]
+                a = 0
+                b = 0
+                c = 0
+                n_shared = 0
+                for w in range(packed.shape[1]):
+                    x = packed[i, w]
+                    y = packed[j, w]
+                    shared = listed[listed_rows[i], w] & listed[listed_rows[j], w]
+                    a += popcount_word(x & y)
+                    b += popcount_word(x & ~y & shared)
+                    c += popcount_word(~x & y & shared)
+                    n_shared += popcount_word(shared)
+                d = n_shared - a - b - c
+                sqrt_ad = np.sqrt(a*d)
+                sims[k] = (sqrt_ad + a) / (sqrt_ad + a + b + c)
+        return sims
+
+def neighbour_similarities(packed, listed, listed_rows, neigh_off, neigh_idx):
+    '''Scores each row of packed against its neighbours neigh_idx[neigh_off[i]:neigh_off[i+1]],
+    row i of packed lists the taxa in listed[listed_rows[i]].'''
+    neigh_off = np.asarray(neigh_off, dtype=np.int64)
+    neigh_idx = np.asarray(neigh_idx, dtype=np.int64)
+    if numba is not None:
+        return neighbour_similarities_jit(packed, listed, listed_rows, neigh_off, neigh_idx)
+    cent_idx = np.repeat(np.arange(len(neigh_off) - 1), np.diff(neigh_off))
+    return baroni_urbani_buser_packed(packed[cent_idx], packed[neigh_idx],
+                                      listed[listed_rows[cent_idx]], listed[listed_rows[neigh_idx]])
+
+def assign_presence_vectors(sample_list):
+    '''Aligns every successful sample to one taxon index and caches its packed presence vector.
+
+    Returns the packed vectors stacked in sample_list order, rows of other samples are left empty,
+    the packed taxa listed by each distinct otu table, and the row of that table for each sample.'''
+    samples = [(row, s) for row, s in enumerate(sample_list) if s.pass_fail == "Successful" and s.counts is not None]
+    taxa = set()
+    for row, sample in samples:
+        taxa.update(sample.taxa)
+    taxon_index = pd.Index(sorted(taxa))
+    n_words = -(-len(taxon_index) // 64)
+    packed = np.zeros((len(sample_list), n_words), dtype=np.uint64)
+    listed = [np.zeros(n_words, dtype=np.uint64)]
+    listed_rows = np.zeros(len(sample_list), dtype=np.int64)
+    indexers = {} #samples from the same run share a taxa index, and so its indexer and listed taxa
+    for row, sample in samples:
+        if id(sample.taxa) not in indexers:
+            indexers[id(sample.taxa)] = (taxon_index.get_indexer(sample.taxa), len(listed))
+            in_table = np.zeros(len(taxon_index), dtype=bool)
+            in_table[indexers[id(sample.taxa)][0]] = True
+            listed.append(pack_presence(in_table))
+        indexer, listed_rows[row] = indexers[id(sample.taxa)]
+        pres = np.zeros(len(taxon_index), dtype=bool)
+        pres[indexer[sample.counts.indices]] = sample.counts.data > 0
+        packed[row] = pack_presence(pres)
+        sample._pres = packed[row]
+    return packed, np.vstack(listed), listed_rows
+
 #dif
 dif = {"PrefTaxon":["EC","IE"],"A":[1,0],"B":[0,1]}
 same = {"PrefTaxon":["EC","IE"],"A":[1,0],"B":[1,0]}
@@ -397,49 +509,49 @@ assert baroni_urbani_buser_coefficient(pd.DataFrame(data=same)) == 1
 
 def perform_similarity_checks(sample_list, writer):
     print("Performing Baroni–Urbani–Buser coefficient similarity checks...")
-    sim_all = []
-    for sample_cent in sample_list:
-        status = sample_cent.folder
-        count = sample_list.index(sample_cent)
-        filled_len = int(round(60 * count / float(len(sample_list))))
-        percents = round(100.0 * count / float(len(sample_list)), 5)
-        bar = '=' * filled_len + '-' * (60 - filled_len)
-        sys.stdout.write('[%s] %s%s Analysing sample: %s\r' % (bar, percents, '%', status))
-        sys.stdout.flush()
-        cent_df = sample_cent.otu_tab
+    packed, listed, listed_rows = assign_presence_vectors(sample_list)
+    plate_map = {} #plate -> {(row, col): indexes in sample_list}, repeat samples share a well
+    for idx, sample in enumerate(sample_list):
+        if sample._pres is None or sample.plate_loc == no_value:
+            continue
+        try:
+            plate_map.setdefault(sample.plate, {}).setdefault(tuple(sample.plate_loc), []).append(idx)
+        except AttributeError:
+            pass
+    #neighbours of sample i are neigh_idx[neigh_off[i]:neigh_off[i+1]], scored in one batch below
+    neigh_off = [0]
+    neigh_idx = []
+    for count, sample_cent in enumerate(sample_list):
+        #redrawing the bar for every sample costs more than the comparisons
+        if count % 100 == 0 or count == len(sample_list) - 1:
+            status = sample_cent.folder
+            filled_len = int(round(60 * count / float(len(sample_list))))
+            percents = round(100.0 * count / float(len(sample_list)), 5)
+            bar = '=' * filled_len + '-' * (60 - filled_len)
+            sys.stdout.write('[%s] %s%s Analysing sample: %s\r' % (bar, percents, '%', status))
+            sys.stdout.flush()
+        if sample_cent.pass_fail == "Successful":
+            try:
+                plate_samples = plate_map.get(sample_cent.plate, {})
+                sur_coords = sample_cent.sur_samples
+            except AttributeError:
+                plate_samples = {}
+                sur_coords = []
+            #only same plate neighbours can be the most similar sample, keep sample_list order for ties
+            sur_idxs = sorted(idx for coord in sur_coords for idx in plate_samples.get(tuple(coord), []))
+            neigh_idx.extend(sur_idx for sur_idx in sur_idxs if sur_idx != count)
+        neigh_off.append(len(neigh_idx))
+    sims = neighbour_similarities(packed, listed, listed_rows, neigh_off, neigh_idx)
+    sim_all = sims.tolist()
+    for count, sample_cent in enumerate(sample_list):
         if sample_cent.pass_fail != "Successful":
             continue
         highest_sim = 0.0
         most_sim_sample = ""
-        for sample_sur in sample_list:
-            if sample_cent == sample_sur:
-                pass
-            else:
-                if sample_sur.pass_fail != "Successful":
-                    continue
-                try:
-                    if sample_cent.plate != sample_sur.plate:
-                        pass
-                    else:
-                        if sample_sur.plate_loc in sample_cent.sur_samples:
-                            sur_df = sample_sur.otu_tab
-                            if not isinstance(sur_df, pd.DataFrame):
-                                continue
-                            df = pd.merge(cent_df, sur_df, on="PrefTaxon")
-                            similarity = baroni_urbani_buser_coefficient(df)
-                            sim_all.append(similarity)
-                            if similarity > highest_sim:
-                                highest_sim = similarity
-                                most_sim_sample = sample_sur.folder
-                        else:
-                            sur_df = sample_sur.otu_tab
-                            if not isinstance(sur_df, pd.DataFrame):
-                                continue
-                            df = pd.merge(cent_df, sur_df, on="PrefTaxon")
-                            similarity = baroni_urbani_buser_coefficient(df)
-                            sim_all.append(similarity)
-                except AttributeError:
-                    pass
+        for k in range(neigh_off[count], neigh_off[count + 1]):
+            if sim_all[k] > highest_sim:
+                highest_sim = sim_all[k]
+                most_sim_sample = sample_list[neigh_idx[k]].folder
         sample_cent.assign_most_sim_sample(highest_sim, most_sim_sample)
     print("\n")
     folder_nums = []
@@ -456,8 +568,11 @@ def perform_similarity_checks(sample_list, writer):
             plates.append(sample.plate)
         except AttributeError:
             plates.append(" ")
-    print("Mean similarity of all samples: " + str(stat.mean(sim_all)))
-    print("Standard deviationm of similarity of all samples: " + str(stat.stdev(sim_all)))
+    if len(sims) > 1:
+        print("Mean similarity of neighbouring samples: " + str(sims.mean()))
+        print("Standard deviation of similarity of neighbouring samples: " + str(sims.std(ddof=1)))
+    else:
+        print("Not enough neighbouring samples to summarise similarity.")
     sim_dict = {"FolderNumber":folder_nums,"Most Similar Sample":sim_samps, "BUB_Co":bub_cos, "Plate":plates}
     sim_df = pd.DataFrame.from_dict(sim_dict)
     sim_df.to_excel(writer, sheet_name="BUB_coefficient", header=True, index=False)
@@ -489,23 +604,19 @@ def import_extraction_sheets(data_dir, xl_file, samples):
     xl_abspath = os.path.join(dir_abspath, xl_file)
     xl = pd.ExcelFile(xl_abspath)
     sheet_names = xl.sheet_names
-    sample_groups = {}
+    by_folder = get_folder_map(samples)
     for sheet_name in sheet_names:
         sheet = xl.parse(sheet_name=sheet_name)
         if sheet.empty:
             pass
         else:
             sheet = sheet.set_index(list(sheet.columns.values)[0])
-            plate = sheet[["Barcode Loc", "Sample ID"]].copy().head(96) 
-            plate_samples = plate["Sample ID"].tolist()
-            new_plate_samples = []
-            for item in plate_samples:
-                new_item = str(item)
-                new_plate_samples.append(new_item)
-            for sample in samples:
-                if sample.folder in new_plate_samples:
-                    row_num = new_plate_samples.index(sample.folder)
-                    barcode_location = plate.iat[row_num, 0]
+            plate = sheet[["Barcode Loc", "Sample ID"]].head(96).to_numpy()
+            plate_samples = {} #sample id -> barcode location of its first well
+            for barcode_location, item in plate:
+                plate_samples.setdefault(str(item), barcode_location)
+            for folder, barcode_location in plate_samples.items():
+                for sample in by_folder.get(folder, []):
                     row_letters = ["A","B","C","D","E","F","G","H"]
                     row = row_letters.index(barcode_location[0])
                     col = int(barcode_location[1])
@@ -515,64 +626,98 @@ def import_extraction_sheets(data_dir, xl_file, samples):
                             sample.amend_sample_note("Sample also found on " + sheet_name)
                     except AttributeError:
                         sample.assign_surrounding_samples(sur_coords, row, col, sheet_name)
-                  
 
-def import_otus(file_name):
-    otus = pd.read_csv(file_name, delimiter = "\t")
-    otus = otus.rename(index=str)
+
+def import_otus(file_name, use_threads=True):
+    if pa_csv is not None:
+        table = pa_csv.read_csv(file_name, read_options=pa_csv.ReadOptions(use_threads=use_threads),
+                                parse_options=pa_csv.ParseOptions(delimiter="\t"))
+        otus = table.to_pandas()
+    else:
+        otus = pd.read_csv(file_name, delimiter = "\t")
     return otus    
 
+def load_otu_file(file_path, use_threads=True):
+    '''Reads an otu table and tidies its sample headers, run in a worker process.'''
+    path,file_name = os.path.split(file_path)
+    otus = import_otus(file_path, use_threads)
+    headers = list(otus.columns.values)
+    headers.pop(0)
+    new_headers = {} #changes made to accomadate formatting of re-demux
+    for header in headers:
+        try:
+            header_split = header.split(".")
+            if header_split[0][0].lower() in ["b","n","p","g","t","u"]:
+                new_header = header_split[0] + header_split[1]
+                new_header = str(new_header)
+            else:
+                new_header = header_split[0]
+            new_headers[header] = new_header
+        except IndexError:
+            print("\nHeader " + str(header) + " has been assumed to have been changed manually.")
+            new_headers[header] = header
+    otus = otus.rename(columns=new_headers)
+    return file_name, otus
+
+def sparse_counts(counts):
+    '''Stores a column of otu counts as a one column CSC matrix, most taxa are absent from any one sample.'''
+    nonzero = np.flatnonzero(counts)
+    return sparse.csc_matrix((counts[nonzero], nonzero, [0, len(nonzero)]), shape=(len(counts), 1))
+
+def otu_counts(otus, header, file_name):
+    '''Reads the otu counts of one sample as integers, blank cells are taken as no reads.'''
+    counts = otus[header].fillna(0)
+    if not pd.api.types.is_numeric_dtype(counts):
+        raise FormatError("Otu table " + str(file_name) + " has non-numeric counts for " + str(header) + ".")
+    counts = counts.to_numpy()
+    if (counts < 0).any() or (counts != np.floor(counts)).any() or counts.max(initial=0) > np.iinfo(np.int32).max:
+        raise FormatError("Otu table " + str(file_name) + " has counts for " + str(header) + " that are not whole numbers of reads.")
+    return counts.astype(np.int32)
+
 def import_otu_tables_main(directory, sample_list):
     dir_abspath = os.path.abspath(directory)
     file_paths = glob.glob(str(dir_abspath) + "/*.tsv")
-    files = []
-    for file_path in file_paths:
-        path,file_name = os.path.split(file_path)
-        files.append(file_name)
-    for file_name in files:
-        otus = import_otus(path + "/" + file_name)
+    if len(file_paths) > 1:
+        with mp.Pool(min(mp.cpu_count(), len(file_paths))) as pool:
+            #workers parse single threaded so the pool is the only source of parallelism
+            otu_files = pool.map(partial(load_otu_file, use_threads=False), file_paths)
+    else:
+        otu_files = [load_otu_file(file_path) for file_path in file_paths]
+    by_folder = get_folder_map(sample_list)
+    known_taxa = [] #runs with identical taxa share one index rather than a copy each
+    for file_name, otus in otu_files:
+        taxa = pd.Index(otus["PrefTaxon"])
+        for run_taxa in known_taxa:
+            if taxa.equals(run_taxa):
+                taxa = run_taxa
+                break
+        else:
+            known_taxa.append(taxa)
         headers = list(otus.columns.values)
         headers.pop(0)
-        new_headers = {} #changes made to accomadate formatting of re-demux
+        headers_added = set()
         for header in headers:
-            try:
-                header_split = header.split(".")
-                if header_split[0][0].lower() in ["b","n","p","g","t","u"]:
-                    new_header = header_split[0] + header_split[1]
-                    new_header = str(new_header)
+            for sample in by_folder.get(header, []):
+                if sample.count > 3000:
+                    headers_added.add(header)
                 else:
-                    new_header = header_split[0]
-                new_headers[header] = new_header
-            except IndexError:
-                print("\nHeader " + str(header) + " has been assumed to have been changed manually.")
-                new_headers[header] = header
-        otus = otus.rename(columns=new_headers)
-        headers = list(otus.columns.values)
-        headers.pop(0)
-        headers_added = []
+                    sample.assign_results(taxa, sparse_counts(otu_counts(otus, header, file_name)), header, file_name)
+                    headers_added.add(header)
+        #walk headers rather than a set difference so controls keep their file order
         for header in headers:
-            for sample in sample_list:
-                if header == str(sample.folder):
-                    if sample.count > 3000:
-                        headers_added.append(header)
-                    else:   
-                        df = otus[["PrefTaxon"]].copy()
-                        df[header] = otus[header].copy()
-                        sample.assign_results(df, file_name)
-                        headers_added.append(header)
-        for header in headers:
-            if header in headers_added:
-                pass
-            else:
+            if header not in headers_added:
                 sample = Diatom_Sample(None, None, None, "Control", None, None, None, None, header)
-                df = otus[["PrefTaxon"]].copy()
-                df[header] = otus[header].copy()
-                sample.assign_results(df, file_name)
+                sample.assign_results(taxa, sparse_counts(otu_counts(otus, header, file_name)), header, file_name)
                 sample.sort_control()
-                sample.otu_tab.columns = ["PrefTaxon", sample.sampleid]
+                sample.otu_header = sample.sampleid
                 sample_list.append(sample)
+                by_folder.setdefault(str(sample.folder), []).append(sample)
+    missing_runs = Counter(sample.batch_num for sample in sample_list if sample.analysis_date == missing_run_metadata)
+    for batch_num, sample_count in missing_runs.items():
+        print(missing_run_metadata + " for run: " + str(batch_num) + " (" + str(sample_count) + " samples)")
     return sample_list
 
+@lru_cache(maxsize=4096) #the same regions and areas repeat across samples
 def get_initials(string):
     xs = (string)
     words_list = xs.split()
@@ -581,6 +726,7 @@ def get_initials(string):
         initials = initials + word[0].upper()
     return initials
 
+@lru_cache(maxsize=4096)
 def get_capital(string):
     xs = (string)
     word_list = xs.split()
@@ -600,18 +746,15 @@ def import_metadata_sepa(inputxl, directory):
     samples_list = []
     samples_info = samples_reg[["Region", "S_SAMPLING_PT_DESC", "SAMPLE_NUMBER", "SAMPLED_DATE"]]
     samples_info.columns = ["region", "site_name", "sepa_num", "sample_date"] 
-    for row in samples_info.itertuples():
+    columns = [samples_info[column].tolist() for column in ["region", "site_name", "sepa_num", "sample_date"]]
+    for region, site_name, sepa_num, sample_date in zip(*columns):
         try:
-            sepa_num = str(int(row[3]))
+            sepa_num = str(int(sepa_num))
         except ValueError:
-            sepa_num = str(row[3])
-        region = get_capital(str(row[1]))
-        site_name = str(row[2])
-        try:
-            sample_date = str(row[4])
-        except ValueError:
-            print("Value for SampleDate not accepted for sample: " + sepa_num + " orignal value: " + str(row[10]))
-            SampleDate = "01/01/18"
+            sepa_num = str(sepa_num)
+        region = get_capital(str(region))
+        site_name = str(site_name)
+        sample_date = str(sample_date)
         diatom_sample_info = Diatom_Sample(sepa_num, "1", "area", region, sepa_num, site_name, sample_date, sepa_num, sepa_num)
         samples_list.append(diatom_sample_info)
     return samples_list
@@ -625,16 +768,8 @@ def import_metadata_ea(inputxl, directory):
     samples_list = []
     samples_info = samples_reg[["Region", "Area", "BIOSYS site ID", "Water body", "Site/Station Name", "Sample Id", "Barcode received", "PRN", "Folder", "Sample Date"]]
     samples_info.columns = ["Region", "Area", "SiteID", "WaterBody", "SiteName", "SampleId", "Barcode_R", "PRN", "Folder", "SampleDate"] 
-    for row in samples_info.itertuples():
-        region = row[1]
-        area = row[2]
-        siteid = row[3]
-        site_name = row[5]
-        sampleid = row[6]
-        barcode = row[7]
-        prn = row[8]
-        folder = row[9]
-        sample_date = row[10]
+    columns = [samples_info[column].tolist() for column in ["Region", "Area", "SiteID", "SiteName", "SampleId", "Barcode_R", "PRN", "Folder", "SampleDate"]]
+    for region, area, siteid, site_name, sampleid, barcode, prn, folder, sample_date in zip(*columns):
         diatom_sample_info = Diatom_Sample(sampleid, siteid, area, region, prn, site_name, sample_date, barcode, folder)
         samples_list.append(diatom_sample_info)
     return samples_list
@@ -659,7 +794,7 @@ def main():
 
     options = get_args()
     
-    writer = pd.ExcelWriter("output.xlsx")
+    writer = pd.ExcelWriter("output.xlsx", engine=EXCEL_ENGINE)
 
     print("Area: " + str(options.area))
     if str(options.area).upper() == "SEPA":
@@ -687,8 +822,6 @@ def main():
 
     community_analysis_export(samples_otus, community_analysis_to_keep_list, control_regions)
 
-    delete_file("inter.text")
-
     writer.save()
 
 if __name__ == "__main__":
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+import unittest
+import importlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import metadata
+except ImportError: #metadata.py is kept private, the example values are enough here
+    sys.modules["metadata"] = importlib.import_module("example_metadata")
+
+import biosys_2019 as biosys
+
+
+class OtuCountsTest(unittest.TestCase):
+    """Checks the otu counts read into samples by import_otu_tables_main."""
+
+    def import_table(self, rows):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, "Run_1.tsv"), "w") as tsv:
+                tsv.write("PrefTaxon\t1001\n")
+                for taxon, count in rows:
+                    tsv.write(taxon + "\t" + count + "\n")
+            sample = biosys.Diatom_Sample("S1", "1", "area", "Region", "1", "Site", "01-01-19", "1001", "1001")
+            biosys.import_otu_tables_main(data_dir, [sample])
+        return sample
+
+    def test_blank_cell_counts_as_no_reads(self):
+        sample = self.import_table([("Taxon A", ""), ("Taxon B", "7"), ("Taxon C", "4000")])
+        self.assertEqual(sample.count, 4007)
+        self.assertEqual(sample.pass_fail, "Successful")
+        self.assertEqual(list(sample.otu_tab["1001"]), [0, 7, 4000])
+
+    def test_fractional_count_is_rejected(self):
+        with self.assertRaises(biosys.FormatError):
+            self.import_table([("Taxon A", "2.5"), ("Taxon B", "7"), ("Taxon C", "4000")])
+
+
+if __name__ == "__main__":
+    unittest.main()